@@ -5,26 +5,39 @@ a limited region although it has awesome features.
 
 context.user_data will store the data related to each user with this format.
 'loc': A (longitude, latitude) tuple of the current location.
+'loc_latlon': The same location as a (latitude, longitude) tuple.
 'last_time': The last time we received information from the user.
 'target': The destination the user wants to go.
 'route': A list with the route values.
+'route_rad': An array with the (latitude, longitude) of each checkpoint in
+             radians.
 'checkpts': The number of checkpoints the route has.
 'curr_chkpt': The current checkpoint he is.
 'waiting': A boolean value so the bot knows when there is no user response.
-'inline-tapped': a list of booleans to avoid the user to repeat inline
-                 keyboard button actions.
-                 Each boolean represents one action.
+'reminder_job': The job that reminds the user to share his location.
+'inline_tapped': a bitmask to avoid the user to repeat inline keyboard
+                 button actions.
+                 Each bit (TAP_* constants) represents one action.
 """
 
+import io
 import os
 import time
+import zipfile
+import functools
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters,
                           CallbackQueryHandler)
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+# The message queue is deprecated since python-telegram-bot 13.3 and removed
+# on 20, which is why requirements.txt asks for a version under 20.
+from telegram.ext import messagequeue as mq
+from telegram.utils.request import Request
+from telegram.error import RetryAfter, TelegramError
+from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
+import requests
 import osmnx as ox
+import numpy as np
 import guide as gd
-import random
-from haversine import haversine
+from math import radians, sin, cos, asin, sqrt, isnan
 
 
 # Create error handlers.
@@ -44,6 +57,51 @@ class NoDestinationError(Error):
     pass
 
 
+class NoPlaceError(Error):
+    pass
+
+
+class NoRouteError(Error):
+    pass
+
+
+class MQBot(Bot):
+    """
+    A bot that sends messages and photos through a message queue, so the
+    flood limits of telegram are not exceeded when many are sent at once.
+    The queue is started and stopped by whoever creates it.
+    """
+
+    def __init__(self, *args, mqueue, is_queued_def=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._is_messages_queued_default = is_queued_def
+        self._msg_queue = mqueue
+
+    def _send(self, method, *args, **kwargs):
+        # The queue keeps the errors of the messages it sends without
+        # showing them, so they are printed here.
+        try:
+            try:
+                return method(*args, **kwargs)
+            except RetryAfter as e:
+                # Telegram asks to wait, which also holds the rest of the
+                # queue.
+                time.sleep(e.retry_after)
+                return method(*args, **kwargs)
+        except TelegramError as e:
+            chat_id = kwargs.get('chat_id', args[0] if args else None)
+            print("Can't send to chat", str(chat_id) + ":", e, "\n")
+            raise
+
+    @mq.queuedmessage
+    def send_message(self, *args, **kwargs):
+        return self._send(super().send_message, *args, **kwargs)
+
+    @mq.queuedmessage
+    def send_photo(self, *args, **kwargs):
+        return self._send(super().send_photo, *args, **kwargs)
+
+
 # Constants declaration.
 PLACE = "Barcelona"  # The working zone of the bot.
 NEAR_DST = 20  # A user is on a checkpoint with this radius.
@@ -51,14 +109,84 @@ AWAY_DST = 80  # A user may be getting lost with this radius.
 FAR_AWAY_DST = 250  # A user is lost with this radius.
 MAX_TIME = 240  # Time to consider a user is no longer sharing its location.
 N = 3  # Maximum checkpoints the user can skip.
+EARTH_RADIUS = 6371000  # Mean radius of the Earth in meters.
+EARTH_DIAMETER = 2 * EARTH_RADIUS
+PORT = 8443  # Default port to listen on when using a webhook.
+POLL_TIMEOUT = 30  # Seconds telegram holds a polling request open.
+GEOCODE_TIMEOUT = 3  # Seconds to wait for Nominatim to geocode a place.
+WORKERS = 8  # Threads that run the slow handlers concurrently.
+
+# Indications for each 22.5 degrees of deviation of the route, clockwise.
+# An angle of 180 probably would never be in a route but a stronger turn
+# should be contemplated.
+_TURNS = (("Go straight",) + ("Turn half right",) * 2 + ("Turn right",) * 2 +
+          ("Turn strong right",) * 3 + ("Turn strong left",) * 3 +
+          ("Turn left",) * 2 + ("Turn half left",) * 2 + ("Go straight",))
+_FINAL_TURNS = (("in front of you",) + ("at your right",) * 7 +
+                ("at your left",) * 7 + ("in front of you",))
+
+# Bits of user_data['inline_tapped'], one for each inline button action.
+TAP_HELP = 1 << 0
+TAP_AUTHORS = 1 << 1
+TAP_WHERE = 1 << 2
+TAP_CANCEL = 1 << 3
+TAP_LOCATION_HELP = 1 << 4
+TAP_GO = 1 << 5
+TAP_RECOMPUTE = 1 << 6
+
+
+@functools.lru_cache(maxsize=4096)
+def _geocode_cached(query):
+    """
+    A private function that geocodes a query, remembering the results so
+    repeated places don't have to be asked to Nominatim again.
+    """
+    return ox.geocode(query)
+
+
+def _looks_like_place(text):
+    """
+    A private function that cheaply checks if a text could be the name of a
+    place, before trying to geocode it.
+    """
+    return (3 <= len(text) <= 80 and
+            sum(c.isalpha() or c.isspace() for c in text) / len(text) > 0.6
+            and not text.startswith(('http', '/', '@')))
+
+
+def _hav_m(a_lat, a_lon, b_lat, b_lon):
+    """
+    A private function that computes the haversine distance in meters between
+    the points (a_lat, a_lon) and (b_lat, b_lon).
+    """
+    rlat1 = radians(a_lat)
+    rlat2 = radians(b_lat)
+    s1 = sin((rlat2 - rlat1) * 0.5)
+    s2 = sin(radians(b_lon - a_lon) * 0.5)
+    return EARTH_DIAMETER * asin(sqrt(s1*s1 + cos(rlat1)*cos(rlat2)*s2*s2))
+
+
+def _distances(location, points):
+    """
+    A private function that computes the haversine distance in meters from
+    the (latitude, longitude) location to each row of the points array, which
+    is given in radians.
+    """
+    lat, lon = np.radians(location)
+    a = (np.sin((points[:, 0] - lat) / 2)**2 + np.cos(lat) *
+         np.cos(points[:, 0]) * np.sin((points[:, 1] - lon) / 2)**2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
 
 
 def start(update, context):
     """
     The command to start a conversation with the bot.
     """
+    chat_id = update.effective_chat.id
+    name = update.effective_chat.first_name
+
     # inline_tapped initialization
-    context.user_data['inline_tapped'] = [False]*7
+    context.user_data['inline_tapped'] = 0
 
     keyboard = [
                 [InlineKeyboardButton("/help", callback_data="help"),
@@ -66,27 +194,28 @@ def start(update, context):
                 ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="Welcome "+update.effective_chat.first_name+"! Whenever you " +
-        "want to start your journey, send me your current location and " +
-        "type /go followed by the place you want to go.",
+        chat_id=chat_id,
+        text="Welcome " + name + "! Whenever you want to start your " +
+        "journey, send me your current location and type /go followed by " +
+        "the place you want to go.",
         reply_markup=reply_markup)
 
-    print(update.effective_chat.first_name+" has entered the chat.\n")
+    print(name+" has entered the chat.\n")
 
 
 def helper(update, context):
     """
     A command that provides the user all things the bot can do.
     """
-    context.user_data['inline_tapped'][4] = False
+    chat_id = update.effective_chat.id
+    context.user_data['inline_tapped'] &= ~TAP_LOCATION_HELP
 
     keyboard = [[InlineKeyboardButton("How do I share my location?",
                                       callback_data="location-help")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     context.bot.send_message(
-        chat_id=update.effective_chat.id,
+        chat_id=chat_id,
         text="Here is all you can do with me! Just write:\n\n" +
         "- /go destiny, to start a guide to your destiny location\n" +
         "- /where, to see where you are\n" +
@@ -102,6 +231,7 @@ def _listener(update, context):
     A private function to analyze the messages sent by the user.
     If one seems like a command, the bot will treat it.
     """
+    chat_id = update.effective_chat.id
     name = update.effective_chat.first_name
     msg = update.message.text.lstrip()
 
@@ -109,41 +239,43 @@ def _listener(update, context):
 
     # The user can misunderstood the functionality of the bot, so
     # the command 'go' would work like '/go', and the same for other commands.
-    if msg[:5] == "start":
-        start(update, context)
-    elif msg[:4] == "help":
-        helper(update, context)
-    elif msg[:2] == "go" or msg[1:3] == 'go':
-        go(update, context)
-    elif msg[:5] == "where":
-        where(update, context)
-    elif msg[:6] == "cancel":
-        cancel(update, context)
-    elif msg[:6] == "author":
-        authors(update, context)
-    elif msg[:9] == "recompute":
-        _compute_route(update, context)
+    words = msg.lstrip('/').split(None, 1)
+    command = _CMDS.get(words[0].lower()) if words else None
+    if command:
+        command(update, context)
     else:
-        context.bot.sendChatAction(update.effective_chat.id, "typing")
         try:
-            ox.geocode(msg)
-            context.user_data['inline_tapped'][5] = False
+            # Most chatter is rejected without asking Nominatim.
+            if not _looks_like_place(msg):
+                raise NoPlaceError
+            context.bot.sendChatAction(chat_id, "typing")
+            _geocode_cached(msg)
+        except requests.exceptions.RequestException as e:
+            # Nominatim didn't answer in time, the text may still be a place.
+            print(e)
+            context.bot.send_message(
+                chat_id=chat_id,
+                text="Sorry, I can't look for places right now.\n" +
+                "Please try again in a moment.")
+        # osmnx raises a plain Exception when Nominatim finds no place.
+        except Exception:
+            context.bot.send_message(
+                chat_id=chat_id,
+                text="Sorry, I didn't understand that.\nTo know what I can " +
+                "do, please type /help and you will see a list of all " +
+                "commands.")
+        else:
+            context.user_data['inline_tapped'] &= ~TAP_GO
             keyboard = [[InlineKeyboardButton("Yes, /go "+str(msg),
                                               callback_data="go "+str(msg))],
                         [InlineKeyboardButton("No", callback_data="null")]
                         ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             context.bot.send_message(
-                chat_id=update.effective_chat.id,
+                chat_id=chat_id,
                 text="Sorry, I didn't understand that at all.\n" +
                 "Did you mean /go "+str(msg)+"?",
                 reply_markup=reply_markup)
-        except:
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Sorry, I didn't understand that.\nTo know what I can " +
-                "do, please type /help and you will see a list of all " +
-                "commands.")
 
 
 def where(update, context):
@@ -155,41 +287,41 @@ def where(update, context):
     Respond: Sends the user a photo containing a map with his location, and
     a message with his coordinates Latitude and Longitude.
     """
+    chat_id = update.effective_chat.id
+    name = update.effective_chat.first_name
     try:
-        location = context.user_data['loc'][::-1]
+        location = context.user_data['loc_latlon']
 
         # Improve the appearence of the chat with the bot.
-        context.bot.sendChatAction(update.effective_chat.id, "upload_photo")
+        context.bot.sendChatAction(chat_id, "upload_photo")
 
-        fname = "%d.png" % random.randint(1000000, 9999999)
-        gd.plot_directions(None, location, None, None, fname)
+        photo = io.BytesIO()
+        gd.plot_directions(None, location, None, None, photo)
+        photo.seek(0)
 
         context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=open(fname, 'rb'))
-        os.remove(fname)
+            chat_id=chat_id,
+            photo=photo)
 
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="Your current location is :\n" +
-            "Latitude: "+str(location[1])+"\n" +
-            "Longitude: "+str(location[0])+"\n")
+            "Latitude: "+str(location[0])+"\n" +
+            "Longitude: "+str(location[1])+"\n")
 
-        print("The actual location of " + update.effective_chat.first_name +
-              " is: \n" +
-              "Latitude: "+str(location[1])+"\n" +
-              "Longitude: "+str(location[0])+"\n")
+        print("The actual location of " + name + " is: \n" +
+              "Latitude: "+str(location[0])+"\n" +
+              "Longitude: "+str(location[1])+"\n")
 
     except KeyError:
-        print("No location of " + str(update.effective_chat.first_name) +
-              " found.")
+        print("No location of " + str(name) + " found.")
 
-        context.user_data['inline_tapped'][4] = False
+        context.user_data['inline_tapped'] &= ~TAP_LOCATION_HELP
         keyboard = [[InlineKeyboardButton("How do I share my location?",
                                           callback_data="location-help")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="Sorry, it seems you are not sharing your location with us.",
             reply_markup=reply_markup)
 
@@ -204,6 +336,8 @@ def go(update, context):
     Then, starts sending messages containing information related to the guide
     every time he achieves a new checkpoint.
     """
+    chat_id = update.effective_chat.id
+    name = update.effective_chat.first_name
     try:
         text = update.message.text
         target = text[3:].lstrip()
@@ -220,17 +354,16 @@ def go(update, context):
     # Treat all possible errors.
     except NoDestinationError:
         # The user has not sent a destination place.
-        print(update.effective_chat.first_name,
-              "didn't send a destination.\n")
+        print(name, "didn't send a destination.\n")
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="You need to give any destination to go.\n" +
             "Example: '/go Tibidabo.")
 
     except Exception as e:
         print(e)
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="Sorry, we've got an internal error.\n" +
             "Please try again.")
 
@@ -239,106 +372,118 @@ def _compute_route(update, context):
     """
     A private function to compute the route that the user demands.
     """
+    chat_id = update.effective_chat.id
+    name = update.effective_chat.first_name
     try:
         graph = context.bot_data['map']
-        location = context.user_data['loc'][::-1]
+        location = context.user_data['loc_latlon']
 
         # Geocode the destination target.
         if context.user_data.get('target'):
             target = context.user_data['target']
         else:
             raise NoTargetError
-        destination = ox.geocode(target)
+        destination = _geocode_cached(target)
 
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="Computing route to " + target + "...")
         # Improves the appearence of the chat with the bot.
-        context.bot.sendChatAction(update.effective_chat.id, "typing")
+        context.bot.sendChatAction(chat_id, "typing")
 
         # Compute the shortest route from location to destination.
         route = gd.get_directions(graph, location, destination)
 
-        print(update.effective_chat.first_name + " started a new " +
-              "journey to " + target + ".\n")
+        print(name + " started a new journey to " + target + ".\n")
+
+        # The indications and the (latitude, longitude) of each checkpoint
+        # are computed only once.
+        for section in route:
+            section['turn_forward'] = _classify_turn(section.get('angle'))
+            section['turn_final'] = _classify_final(section.get('angle'))
+            section['mid_latlon'] = section['mid'][::-1]
+
+        # The checkpoints in radians, to compute the distances to them all
+        # at once.
+        route_rad = np.radians([section['mid_latlon'] for section in route])
 
         # Store the route and the number of checkpoints on user_data.
-        context.user_data['route'] = route
+        # The locations of the user are checked against the route on another
+        # thread, so the previous route (and its reminder) is removed first
+        # and the new one is stored last, once everything it needs is there.
+        _end_route(context)
         checkpoints = len(route)
+        context.user_data['route_rad'] = route_rad
         context.user_data['checkpts'] = checkpoints
         context.user_data['curr_chkpt'] = 0
+        context.user_data['route'] = route
 
         # Sent the bot a photo of the trip.
-        fname = "%d.png" % random.randint(1000000, 9999999)
-        gd.plot_directions(graph, location, destination, route, fname)
+        photo = io.BytesIO()
+        gd.plot_directions(graph, location, destination, route, photo)
+        photo.seek(0)
         context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=open(fname, 'rb'))
-        os.remove(fname)
+            chat_id=chat_id,
+            photo=photo)
 
         # If the route has only two checkpoints, just sent the photo.
         if checkpoints == 2:
-            # Invert the coordinates because of haversine function
-            mid = route[0]['mid'][::-1]
-            distance = round((haversine(location, mid, 'm') +
-                              haversine(mid, destination, 'm')))
+            mid = route[0]['mid_latlon']
+            distance = round((_hav_m(*location, *mid) +
+                              _hav_m(*mid, *destination)))
             raise TooNearError
 
         # Otherwise guide the user to the first checkpoint.
         msg = _message_route(update, context)
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text=msg,
             parse_mode="Markdown")
 
         # Add a job to the job queue, call _callback_no_response every
         # 60 seconds.
-        context.job_queue.start()
-        context.job_queue.run_repeating(_callback_no_response, 60, 60,
-                                        context={'update': update,
-                                                 'context': context})
+        context.user_data['reminder_job'] = context.job_queue.run_repeating(
+            _callback_no_response, 60, 60,
+            context={'update': update, 'context': context})
 
     # Treat all possible errors.
     except NoTargetError:
         # The user has not a target from a previous route.
-        print(update.effective_chat.first_name,
-              "has no target destination.\n")
+        print(name, "has no target destination.\n")
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="You don't have any previous route to recompute.\n" +
             "Start one for example by typing: /go Tibidabo.")
     except TooNearError:
         # The place the user wants to go is just one node or less away.
-        print("Destiny of " + update.effective_chat.first_name +
-              " too near.\n")
+        print("Destiny of " + name + " too near.\n")
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="Your destiny is too near! Just " + str(distance) +
             " meters away!")
 
     except KeyError:
         # The user is not sharing his location with us.
-        print("No location of the user", update.effective_chat.first_name,
-              "found.\n")
+        print("No location of the user", name, "found.\n")
 
-        context.user_data['inline_tapped'][4] = False
+        context.user_data['inline_tapped'] &= ~TAP_LOCATION_HELP
 
         keyboard = [[InlineKeyboardButton("How do I share my location?",
                                           callback_data="location-help")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="Sorry, it seems you are not sharing your location with us.",
             reply_markup=reply_markup)
 
     except AssertionError as e:
         if str(e)[:11] == "destination":
             context.bot.send_message(
-                chat_id=update.effective_chat.id,
+                chat_id=chat_id,
                 text="Sorry, your destination is not in " + PLACE + ".")
         elif str(e)[:6] == "source":
             context.bot.send_message(
-                chat_id=update.effective_chat.id,
+                chat_id=chat_id,
                 text="Sorry, you are not in " + PLACE + ".")
 
     except Exception as e:
@@ -346,14 +491,14 @@ def _compute_route(update, context):
         # Geocode returned no results for the destination query.
         if (str(e)[:9] == "Nominatim"):
             context.bot.send_message(
-                chat_id=update.effective_chat.id,
+                chat_id=chat_id,
                 text="It seems *" + target +
                 "* is not a place at all, try with other words.",
                 parse_mode="Markdown")
         # Another kind of error happened.
         else:
             context.bot.send_message(
-                chat_id=update.effective_chat.id,
+                chat_id=chat_id,
                 text="Sorry, we've got an internal error.\n" +
                 "Please try again.")
 
@@ -363,19 +508,24 @@ def _update_and_check(update, context):
     A private function that updates the current location and time of the user
     and checks his current route.
     """
+    chat_id = update.effective_chat.id
+    name = update.effective_chat.first_name
+
     # Get the location of the user.
     message = (update.edited_message if update.edited_message
                else update.message)
 
-    location = message.location.longitude, message.location.latitude
+    latitude = message.location.latitude
+    longitude = message.location.longitude
+    location = longitude, latitude
 
     # Store the current location and time on his user data.
     context.user_data['loc'] = location
+    context.user_data['loc_latlon'] = latitude, longitude
     context.user_data['last_time'] = int(time.time())
     context.user_data['waiting'] = False
 
-    print("The location of", update.effective_chat.first_name, "is:",
-          location, ".\n")
+    print("The location of", name, "is:", location, ".\n")
 
     # If the user has an active route, check if he is near a checkpoint.
     if context.user_data.get('route'):
@@ -385,59 +535,55 @@ def _update_and_check(update, context):
         # If the user is near one of the first N checkpoints, he achieves it.
         # The bigger N is the better it works if the user skips any checkpoint,
         # although we lose temporal efficiency.
-        current_distance = None
-        is_near = False
-        for i in range(N):
-            if current + i < checkpts:
-                # Distance of the user to the (current+i)-th checkpoint.
-                next_chkpt = context.user_data['route'][current + i]['mid']
-                current_distance = round(haversine(location[::-1],
-                                                   next_chkpt[::-1], 'm'))
-                print("The user", update.effective_chat.first_name, "is",
-                      current_distance, "meters from #", i, ".\n")
-
-            if current_distance and current_distance < NEAR_DST:
-                # Update checkpoint and send the guiding message.
-                is_near = True
-                context.user_data['curr_chkpt'] = current + i + 1
-                message = _message_route(update, context)
+        distances = _distances((latitude, longitude),
+                               context.user_data['route_rad'][
+                                   current:current + N])
+        print("The user", name, "is",
+              [round(d) for d in distances.tolist()], "meters from the next",
+              "checkpoints.\n")
+
+        near = distances < NEAR_DST
+        if near.any():
+            # The first checkpoint the user is near to.
+            i = int(np.argmax(near))
+
+            # Update checkpoint and send the guiding message.
+            context.user_data['curr_chkpt'] = current + i + 1
+            message = _message_route(update, context)
+
+            # To send a share button under the message when finished route
+            if current + i + 1 == checkpts - 1:
+                share_msg = ("I have travelled to **" +
+                             str(context.user_data['target']) +
+                             "** with this bot, it's amazing! 😄")
+                user_msg = "Yes, share the bot with my friends!"
+                keyboard = [[
+                    InlineKeyboardButton(user_msg,
+                                         switch_inline_query=share_msg)
+                    ]]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                message += "\nDid you enjoy your journey?"
+            else:
+                reply_markup = None
 
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=message,
-                    parse_mode="Markdown")
-
-                # To send a share button when finished route
-                if current + i + 1 == checkpts - 1:
-                    share_msg = ("I have travelled to **" +
-                                 str(context.user_data['target']) +
-                                 "** with this bot, it's amazing! 😄")
-                    user_msg = "Yes, share the bot with my friends!"
-                    keyboard = [[
-                        InlineKeyboardButton(user_msg,
-                                             switch_inline_query=share_msg)
-                        ]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text="Did you enjoy your journey?",
-                        reply_markup=reply_markup)
-
-                print(str(update.effective_chat.first_name) + " moved to #" +
-                      str(current+i+1) + " of #" + str(checkpts-1) + ".\n")
+            context.bot.send_message(
+                chat_id=chat_id,
+                text=message,
+                parse_mode="Markdown",
+                reply_markup=reply_markup)
+
+            print(str(name) + " moved to #" +
+                  str(current+i+1) + " of #" + str(checkpts-1) + ".\n")
 
         # Check if the user is getting away from the checkpoint.
-        if not is_near:
-            next_chkpt = context.user_data['route'][current]['mid']
-            current_distance = round(haversine(location[::-1],
-                                               next_chkpt[::-1], 'm'))
+        else:
+            current_distance = round(float(distances[0]))
             # Minimum distance to be sure the user is really going away.
             min_distance = context.user_data['route'][current].get('length')
 
             # If is getting far away from then recompute the route.
             if min_distance and current_distance > min_distance + FAR_AWAY_DST:
-                context.user_data['inline_tapped'][6] = False
+                context.user_data['inline_tapped'] &= ~TAP_RECOMPUTE
                 keyboard = [[InlineKeyboardButton("Yes, /recompute ",
                                                   callback_data="recompute"),
                             InlineKeyboardButton("No", callback_data="null")]
@@ -447,7 +593,7 @@ def _update_and_check(update, context):
                            "Do you want to recompute your route?")
 
                 context.bot.send_message(
-                    chat_id=update.effective_chat.id,
+                    chat_id=chat_id,
                     text=message,
                     reply_markup=reply_markup)
 
@@ -461,14 +607,47 @@ def _update_and_check(update, context):
                            str(current_distance) +
                            " meters from the next checkpoint!")
 
-                context.user_data['inline_tapped'][2] = False
+                context.user_data['inline_tapped'] &= ~TAP_WHERE
                 context.bot.send_message(
-                    chat_id=update.effective_chat.id,
+                    chat_id=chat_id,
                     text=message,
                     reply_markup=reply_markup)
 
-                print(update.effective_chat.first_name, " is walking",
-                      "away from his checkpoint.\n")
+                print(name, " is walking away from his checkpoint.\n")
+
+
+def _classify_turn(angle):
+    """
+    A private function that returns the indication to follow a deviation of
+    angle degrees on the route.
+    """
+    if angle and not isnan(angle):
+        return _TURNS[int(angle % 360 / 22.5)]
+    return "Go straight"
+
+
+def _classify_final(angle):
+    """
+    A private function that returns where the destination is when the last
+    checkpoint is left with a deviation of angle degrees.
+    """
+    if angle and not isnan(angle):
+        return _FINAL_TURNS[int(angle % 360 / 22.5)]
+    return "in front of you"
+
+
+def _end_route(context):
+    """
+    A private function that deletes the route of the user, except the target,
+    and stops reminding him to share his location.
+    """
+    job = context.user_data.pop('reminder_job', None)
+    if job:
+        job.schedule_removal()
+
+    # The route goes first, so the location checks stop using it.
+    for key in ('route', 'route_rad', 'checkpts', 'curr_chkpt'):
+        context.user_data.pop(key, None)
 
 
 def _message_route(update, context):
@@ -477,15 +656,18 @@ def _message_route(update, context):
     message or if finished it ends the route.
     Returns a string containing the message.
     """
+    chat_id = update.effective_chat.id
+
     # Get the stored data related to the user.
     route = context.user_data['route']
     loc = context.user_data['loc']
+    loc_latlon = context.user_data['loc_latlon']
     current = context.user_data['curr_chkpt']
     last = context.user_data['checkpts'] - 1
 
     # First iteration
     if current == 0:
-        dist = round(haversine(loc[::-1], route[0]['mid'][::-1], 'm'))
+        dist = round(_hav_m(*loc_latlon, *route[0]['mid_latlon']))
         msg = ("You are at " + str(loc) + ".\n"
                "Start at checkpoint #1 of #" + str(last) + ": " +
                str(route[0]['mid']) + ".\n*" + route[0]['next_name'] +
@@ -493,32 +675,9 @@ def _message_route(update, context):
 
     # Medium iterations
     elif current < last:
-        angle = route[current-1].get('angle')
+        turn = route[current-1]['turn_forward']
         dist = round(route[current].get('length'))
 
-        # Angle deviation checking
-        if angle:
-            if 0 < angle < 22.5:
-                turn = "Go straight"
-            elif angle < 67.5:
-                turn = "Turn half right"
-            elif angle < 112.5:
-                turn = "Turn right"
-            # An angle of 180 probably would never be in a route but a
-            # stronger turn should be contemplated.
-            elif angle < 180:
-                turn = "Turn strong right"
-            elif angle < 247.5:
-                turn = "Turn strong left"
-            elif angle < 292.5:
-                turn = "Turn left"
-            elif angle < 337.5:
-                turn = "Turn half left"
-            else:
-                turn = "Go straight"
-        else:
-            turn = "Go straight"
-
         msg = ("Well done! You have reached checkpoint #" + str(current) +
                " of #" + str(last) + "!\n"
                "You are at " + str(loc) + ".\n"
@@ -529,38 +688,24 @@ def _message_route(update, context):
 
     # Last iteration
     else:
-        destination = route[-1]['mid'][::-1]
-        dist = round(haversine(loc[::-1], destination, 'm'))
-        angle = route[current-1].get('angle')
-
-        if angle:
-            if 0 < angle < 22.5:
-                turn = "in front of you"
-            elif angle < 180:
-                turn = "at your right"
-            elif angle < 337.5:
-                turn = "at your left"
-            else:
-                turn = "in front of you"
-        else:
-            turn = "in front of you"
+        destination = route[-1]['mid_latlon']
+        dist = round(_hav_m(*loc_latlon, *destination))
+        turn = route[current-1]['turn_final']
 
         msg = ("Congratulations, last checkpoint achieved! 🥳\n" +
                "*Your destination is " + str(dist) + " meters " + turn +
                " .*\n")
 
         # Send a photo with the location of the user and its destination
-        fname = "%d.png" % random.randint(1000000, 9999999)
-        gd.plot_directions(None, loc[::-1], destination, None, fname)
+        photo = io.BytesIO()
+        gd.plot_directions(None, loc_latlon, destination, None, photo)
+        photo.seek(0)
         context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=open(fname, 'rb'))
-        os.remove(fname)
+            chat_id=chat_id,
+            photo=photo)
 
         # Delete the route from the user.
-        del context.user_data['route']
-        del context.user_data['checkpts']
-        del context.user_data['curr_chkpt']
+        _end_route(context)
 
     # Return the message we will send to the user to guide him.
     return msg
@@ -573,11 +718,12 @@ def _callback_no_response(context):
     """
     update = context.job.context['update']
     context = context.job.context['context']
+    chat_id = update.effective_chat.id
 
     if 'waiting' in context.user_data and not context.user_data['waiting']:
         if time.time() - context.user_data['last_time'] > MAX_TIME:
-            context.user_data['inline_tapped'][3] = False
-            context.user_data['inline_tapped'][4] = False
+            context.user_data['inline_tapped'] &= ~TAP_CANCEL
+            context.user_data['inline_tapped'] &= ~TAP_LOCATION_HELP
 
             keyboard = [
                 [InlineKeyboardButton("Yes, I'll share my location",
@@ -592,7 +738,7 @@ def _callback_no_response(context):
             # To avoid sending multiple messages if the user is not responding
             context.user_data['waiting'] = True
             context.bot.send_message(
-                    chat_id=update.effective_chat.id,
+                    chat_id=chat_id,
                     text="You haven't moved in a while, maybe your location " +
                     "went off...\nDo you want to continue the route?",
                     reply_markup=reply_markup)
@@ -603,66 +749,67 @@ def _button(update, context):
     Handles the queries received from the inline buttons.
     Each button represents one different action.
 
-    The actions are linked with the booleans from user_data['inline_tapped']
-    When a button is sent to the user, the boolean from the position of the
-    action have to be False.
-
-    Each position to the boolean represents:
-        0 : help
-        1 : authors
-        2 : where
-        3 : cancel
-        4 : location-help
-        5 : go
-        6 : recompute
+    The actions are linked with the bits from user_data['inline_tapped']
+    When a button is sent to the user, the bit of the action has to be
+    cleared.
+
+    Each bit represents:
+        TAP_HELP : help
+        TAP_AUTHORS : authors
+        TAP_WHERE : where
+        TAP_CANCEL : cancel
+        TAP_LOCATION_HELP : location-help
+        TAP_GO : go
+        TAP_RECOMPUTE : recompute
     """
+    chat_id = update.effective_chat.id
 
     # Get the action to be performed.
     query = update.callback_query
     action = query['data']
 
-    # To know if the user has tapped twice on the button, booleans from
+    # To know if the user has tapped twice on the button, bits from
     # user_data['inline_tapped'] are used.
-    # After an action is done, the boolean is set to True to avoid the
+    # After an action is done, the bit is set to avoid the
     # user from tapping multiple times and getting the same action more than
     # once.
     tapped = context.user_data['inline_tapped']
 
-    if action == "help" and not tapped[0]:
-        context.user_data['inline_tapped'][0] = True
+    if action == "help" and not tapped & TAP_HELP:
+        context.user_data['inline_tapped'] |= TAP_HELP
         helper(update, context)
 
-    elif action == "authors" and not tapped[1]:
-        context.user_data['inline_tapped'][1] = True
+    elif action == "authors" and not tapped & TAP_AUTHORS:
+        context.user_data['inline_tapped'] |= TAP_AUTHORS
         authors(update, context)
 
-    elif action == "where" and not tapped[2]:
-        context.user_data['inline_tapped'][2] = True
+    elif action == "where" and not tapped & TAP_WHERE:
+        context.user_data['inline_tapped'] |= TAP_WHERE
         where(update, context)
 
-    elif action == "cancel" and not tapped[3]:
-        context.user_data['inline_tapped'][3] = True
+    elif action == "cancel" and not tapped & TAP_CANCEL:
+        context.user_data['inline_tapped'] |= TAP_CANCEL
         cancel(update, context)
 
-    elif action == "location-help" and not tapped[4]:
-        context.user_data['inline_tapped'][4] = True
+    elif action == "location-help" and not tapped & TAP_LOCATION_HELP:
+        context.user_data['inline_tapped'] |= TAP_LOCATION_HELP
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="1. Tap on the icon 📎 at bottom-right.\n " +
             "2. Tap on *Location*.\n\n3. Select *Share My Live Location " +
             "for...*\n\n4. Select for how long.\n\nDone!",
             parse_mode="Markdown")
 
-    elif action[:2] == "go" and not tapped[5]:
-        context.user_data['inline_tapped'][5] = True
+    elif action[:2] == "go" and not tapped & TAP_GO:
+        context.user_data['inline_tapped'] |= TAP_GO
 
         # Saves the place the user want to go to compute a route to there.
         context.user_data['target'] = action[3:]
 
         _compute_route(update, context)
 
-    elif action == "recompute" and not tapped[6]:
-        context.user_data['inline_tapped'][5] = True
+    elif action == "recompute" and not tapped & TAP_RECOMPUTE:
+        context.user_data['inline_tapped'] |= TAP_RECOMPUTE
 
         _compute_route(update, context)
 
@@ -674,25 +821,25 @@ def cancel(update, context):
     """
     A command to stop the current guide.
     """
+    chat_id = update.effective_chat.id
+    name = update.effective_chat.first_name
     try:
-        # Remove all jobs to stop reminding the user if it's still there.
-        context.job_queue.stop()
+        if 'route' not in context.user_data:
+            raise NoRouteError
 
-        # Delete the information about the route, except the target.
-        del context.user_data['route']
-        del context.user_data['checkpts']
-        del context.user_data['curr_chkpt']
+        # Delete the information about the route, except the target, and
+        # stop reminding him.
+        _end_route(context)
 
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="Route succesfully cancelled.")
 
-        print(update.effective_chat.first_name, "has cancelled his route.")
+        print(name, "has cancelled his route.")
 
-    except Exception as e:
-        print(e)
+    except NoRouteError:
         context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="There's no route to cancel but you can start a new one.")
 
 
@@ -700,60 +847,120 @@ def authors(update, context):
     """
     A command to see the authors of the guiding bot and guide module.
     """
+    chat_id = update.effective_chat.id
     context.bot.send_message(
-        chat_id=update.effective_chat.id,
+        chat_id=chat_id,
         text="The authors of this project are:\n" +
         "- Dani Gómez\n" +
         "- David Pujalte\n")
 
 
+# Commands that can also be written as plain text, by their first word.
+_CMDS = {
+    'start': start,
+    'help': helper,
+    'go': go,
+    'where': where,
+    'cancel': cancel,
+    'author': authors,
+    'authors': authors,
+    'recompute': _compute_route,
+    }
+
+
+def _start(updater, token):
+    """
+    A private function to start receiving updates from telegram.
+    If WEBHOOK_URL is set, telegram pushes the updates to the bot, otherwise
+    the bot long polls for them.
+    """
+    # Once the map is loaded osmnx is only used to geocode, which should not
+    # keep a worker waiting for long. osmnx 1.9 renamed settings.timeout to
+    # settings.requests_timeout and 2.0 removes the old name, which is why
+    # requirements.txt asks for a version under 2.
+    if hasattr(ox.settings, 'requests_timeout'):
+        ox.settings.requests_timeout = GEOCODE_TIMEOUT
+    else:
+        ox.settings.timeout = GEOCODE_TIMEOUT
+
+    url = os.environ.get('WEBHOOK_URL')
+    if url:
+        # The webhook is set by start_webhook itself, with the public url.
+        updater.start_webhook(listen="0.0.0.0",
+                              port=int(os.environ.get('PORT', PORT)),
+                              url_path=token, webhook_url=url + token)
+    else:
+        # Long polling, telegram answers as soon as an update arrives.
+        updater.start_polling(poll_interval=0.0, timeout=POLL_TIMEOUT,
+                              bootstrap_retries=-1)
+
+
 def main():
     # Open the token and the dispatcher of our bot.
     Tkn = open('token.txt').read().strip()
-    updater = Updater(token=Tkn, use_context=True)
+    # Messages are queued to send at most 29 of them every 1017 milliseconds,
+    # under the 30 messages per second that telegram allows.
+    queue = mq.MessageQueue(all_burst_limit=29, all_time_limit_ms=1017)
+    bot = MQBot(Tkn, request=Request(con_pool_size=WORKERS + 4),
+                mqueue=queue)
+    updater = Updater(bot=bot, use_context=True, workers=WORKERS)
     dispatcher = updater.dispatcher
 
     # Set the commands that our bot will handle.
+    # The handlers that geocode, compute routes or plot maps run on the
+    # worker threads, so they don't stop the updates of other users.
     dispatcher.add_handler(CommandHandler('start', start))
     dispatcher.add_handler(CommandHandler('help', helper))
-    dispatcher.add_handler(CommandHandler('go', go))
-    dispatcher.add_handler(CommandHandler('recompute', _compute_route))
-    dispatcher.add_handler(CommandHandler('where', where))
+    dispatcher.add_handler(CommandHandler('go', go, run_async=True))
+    dispatcher.add_handler(CommandHandler('recompute', _compute_route,
+                                          run_async=True))
+    dispatcher.add_handler(CommandHandler('where', where, run_async=True))
     dispatcher.add_handler(CommandHandler('cancel', cancel))
     dispatcher.add_handler(CommandHandler('author', authors))
 
     # Set the chat filters we will use at our functions.
-    dispatcher.add_handler(MessageHandler(Filters.text, _listener))
+    dispatcher.add_handler(MessageHandler(Filters.text, _listener,
+                                          run_async=True))
     dispatcher.add_handler(MessageHandler(Filters.location, _update_and_check))
 
     # Set the Callback Queries to handle.
-    dispatcher.add_handler(CallbackQueryHandler(_button))
+    dispatcher.add_handler(CallbackQueryHandler(_button, run_async=True))
 
-    # Store the map of the place we want our bot to guide, so this way it
-    # does not have to be loaded every time.
-    # Download is proceeded if the graph is not on the directory
+    # The threads of the updater and the message queue would keep the
+    # process alive if the bot stops or can't start, so they are always
+    # stopped at the end.
     try:
-        dispatcher.bot_data['map'] = gd.load_graph(PLACE)
-        print("Bot started and working in", PLACE, "\n")
-        # Start the bot.
-        updater.start_polling()
-    except:
-        print(PLACE + ".gpickle not found, downloading", PLACE, "graph.\n")
-
+        # Store the map of the place we want our bot to guide, so this way it
+        # does not have to be loaded every time.
+        # Download is proceeded if the graph is not on the directory
         try:
-            dispatcher.bot_data['map'] = gd.download_graph(PLACE)
-            gd.save_graph(dispatcher.bot_data['map'], PLACE)
-            print(PLACE + ".gpickle downloaded at", os.getcwd(), "\n")
-            print("Bot started and working in", PLACE, "\n")
-            # Start the bot.
-            updater.start_polling()
-        except:
-            print("Can not download the graph from", PLACE, "\nPlease,",
-                  "close the bot and change the place in order to start",
-                  "the bot.\n")
-            # To let the programmer read the message if bot.py is executed on
-            # an external terminal.
-            time.sleep(5)
+            dispatcher.bot_data['map'] = gd.load_graph(PLACE)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            print(PLACE + ".npz not found, downloading", PLACE, "graph.\n")
+
+            try:
+                dispatcher.bot_data['map'] = gd.download_graph(PLACE)
+                gd.save_graph(dispatcher.bot_data['map'], PLACE)
+            except Exception:
+                print("Can not download the graph from", PLACE, "\nPlease,",
+                      "close the bot and change the place in order to start",
+                      "the bot.\n")
+                # To let the programmer read the message if bot.py is
+                # executed on an external terminal.
+                time.sleep(5)
+                return
+            print(PLACE + ".npz downloaded at", os.getcwd(), "\n")
+
+        # Index the map now, so the first route is not slower.
+        gd.index_graph(dispatcher.bot_data['map'])
+        print("Bot started and working in", PLACE, "\n")
+        # Start the bot, until it's stopped with Ctrl-C or a signal.
+        _start(updater, Tkn)
+        updater.idle()
+    finally:
+        # Stopping a stopped updater does nothing.
+        updater.stop()
+        queue.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,2 @@
+# Makes pytest add this directory to sys.path, so the tests can import the
+# bot modules.
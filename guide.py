@@ -5,15 +5,171 @@ The module works treating coordinates as a tuple of (latitude, longitude)
 coordinates.
 """
 
-import random
+import os
+import json
+import collections
+import threading
+import weakref
+import hashlib
+from math import asin, isnan
+import numpy as np
 import osmnx as ox
 import networkx as nx
+import rtree
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from staticmap import StaticMap, CircleMarker, IconMarker, Line
 
 
 # Constants declaration
-FIND_DST = 1000  # the maximum distance to find the nearest edge
 FARTHEST_NODE = 2000  # the maximum distance to consider a node out-of-bounds
+EARTH_RADIUS = 6371009  # the radius of the earth in meters, as used by osmnx
+# The edge attributes needed to compute and describe routes
+EDGE_ATTRIBUTES = {'osmid', 'name', 'length', 'bearing'}
+EDGE_CANDIDATES = 8  # the first edges checked when finding the nearest edge
+TILE_CACHE = 'tile_cache'  # the directory where the map tiles are kept
+TILE_CACHE_SIZE = 2000  # the most map tiles kept on TILE_CACHE
+LOCATION_DECIMALS = 5  # the decimals locations are rounded to on routes
+CACHED_PATHS = 2048  # the shortest paths remembered for each graph
+CACHED_ROUTES = 4096  # the routes remembered for each graph
+
+# The spatial indexes of each graph, built by index_graph. They are dropped
+# with the graph, so nothing they hold may refer to the graph.
+_INDEXES = weakref.WeakKeyDictionary()
+
+
+class _LRUCache:
+    """
+    A thread-safe cache that remembers the last 'maxsize' values used.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, *args):
+        """
+        Return the value of key, computing it as compute(*args) if it's not
+        remembered. Errors are not remembered.
+        """
+
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+
+        # Computed without the lock, so other keys are not kept waiting.
+        value = compute(*args)
+        with self._lock:
+            self._values[key] = value
+            if len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+        return value
+
+
+class _CachedStaticMap(StaticMap):
+    """
+    A StaticMap that keeps the map tiles it downloads on TILE_CACHE, so the
+    tiles shown on previous maps are not downloaded again. Only the last
+    TILE_CACHE_SIZE tiles used are kept.
+    """
+
+    def get(self, url, **kwargs):
+        # The whole url is hashed, so tiles that only differ on the query
+        # don't share a file.
+        path = os.path.join(TILE_CACHE,
+                            hashlib.sha1(url.encode()).hexdigest() + '.png')
+        try:
+            with open(path, 'rb') as file:
+                content = file.read()
+            # The tiles used are touched, so the oldest ones are the least
+            # recently used.
+            os.utime(path)
+            return 200, content
+        except OSError:
+            pass
+
+        status_code, content = super().get(url, **kwargs)
+        if status_code == 200:
+            # The tile is written aside and then renamed, so the threads
+            # drawing other maps never read a half-written tile.
+            temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+            try:
+                os.makedirs(TILE_CACHE, exist_ok=True)
+                with open(temporary, 'wb') as file:
+                    file.write(content)
+                os.replace(temporary, path)
+            except OSError:
+                pass
+            _prune_tiles()
+        return status_code, content
+
+
+def _prune_tiles():
+    """
+    Remove the least recently used tiles of TILE_CACHE, so only the last
+    TILE_CACHE_SIZE are kept.
+    """
+
+    tiles = []
+    try:
+        for entry in os.scandir(TILE_CACHE):
+            if entry.name.endswith('.png'):
+                tiles.append((entry.stat().st_mtime, entry.path))
+    except OSError:
+        # Other threads may be removing tiles at the same time.
+        return
+
+    if len(tiles) > TILE_CACHE_SIZE:
+        tiles.sort(reverse=True)
+        for mtime, path in tiles[TILE_CACHE_SIZE:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _bearings(lats1, lons1, lats2, lons2):
+    """
+    Compute the compass bearings, in degrees, from the points (lats1, lons1)
+    to the points (lats2, lons2), as osmnx.bearing.calculate_bearing does.
+    The coordinates are in degrees, and can be numpy arrays or numbers.
+    """
+
+    lats1, lons1 = np.radians(lats1), np.radians(lons1)
+    lats2, lons2 = np.radians(lats2), np.radians(lons2)
+
+    delta_lons = lons2 - lons1
+    x = np.sin(delta_lons) * np.cos(lats2)
+    y = (np.cos(lats1) * np.sin(lats2) -
+         np.sin(lats1) * np.cos(lats2) * np.cos(delta_lons))
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+
+def _prepare_edges(graph):
+    """
+    Add the compass bearing, in degrees, from u to v to every edge of the
+    graph, as ox.add_edge_bearings does, but computed for all the edges at
+    once with _bearings. Self-loops have no bearing, so they get NaN.
+    The other edge information (like the geometry) is removed in the same
+    pass, because it's not needed and takes a lot of space and time to save
+    and load.
+    """
+
+    edges = list(graph.edges(data=True))
+    lats1 = np.array([graph.nodes[u]['y'] for u, v, edge in edges])
+    lons1 = np.array([graph.nodes[u]['x'] for u, v, edge in edges])
+    lats2 = np.array([graph.nodes[v]['y'] for u, v, edge in edges])
+    lons2 = np.array([graph.nodes[v]['x'] for u, v, edge in edges])
+
+    bearings = np.round(_bearings(lats1, lons1, lats2, lons2), 3)
+
+    for (u, v, edge), bearing in zip(edges, bearings.tolist()):
+        for attribute in edge.keys() - EDGE_ATTRIBUTES:
+            del edge[attribute]
+        edge['bearing'] = bearing if u != v else np.nan
 
 
 def download_graph(place):
@@ -32,27 +188,30 @@ def download_graph(place):
 
     try:
         graph = ox.graph_from_place(place, network_type='drive', simplify=True)
-        ox.geo_utils.add_edge_bearings(graph)
-
-        # For each node and its information...
-        for node1, info1 in graph.nodes.items():
-            # For each adjacent node and its information...
-            for node2, info2 in graph.adj[node1].items():
-                # Only the first edge is considerated
-                edge = info2[0]
-                # Remove geometry information from edges because it's not
-                # needed and takes a lot of space
-                if 'geometry' in edge:
-                    del(edge['geometry'])
+        _prepare_edges(graph)
     except KeyError:
         raise TypeError("Can't download a graph from " + place + ".")
 
     return graph
 
 
+def _graph_files(filename):
+    """
+    Return the names of the numpy and json files where the graph saved as
+    'filename' is stored.
+    """
+
+    if filename[-4:] == '.npz':
+        filename = filename[:-4]
+    return filename + '.npz', filename + '.json'
+
+
 def save_graph(graph, filename):
     """
-    Save a graph at the file 'filename' in gpickle format
+    Save a graph at the files 'filename'.npz and 'filename'.json.
+    The coordinates of the nodes and the endpoints, lengths and bearings of
+    the edges are saved as numpy arrays, and the osmids and names of the
+    edges, which can be lists, in the json file.
 
     Parameters
     ----------
@@ -67,13 +226,52 @@ def save_graph(graph, filename):
 
     """
 
-    nx.write_gpickle(graph, (filename if filename[-8:] == '.gpickle'
-                             else filename+'.gpickle'))
+    arrays_file, attributes_file = _graph_files(filename)
+
+    nodes = graph.nodes(data=True)
+    edges = list(graph.edges(keys=True, data=True))
+
+    # Both files are written aside and then renamed, so an interrupted save
+    # never leaves a half-written graph.
+    with open(attributes_file + '.tmp', 'w') as file:
+        json.dump({
+            'graph': graph.graph,
+            'osmid': [edge.get('osmid') for u, v, key, edge in edges],
+            'name': [edge.get('name') for u, v, key, edge in edges]
+            }, file)
+
+    with open(arrays_file + '.tmp', 'wb') as file:
+        np.savez(
+            file,
+            nodes_id=np.array([node for node, data in nodes],
+                              dtype=np.int64),
+            xs=np.array([data['x'] for node, data in nodes],
+                        dtype=np.float64),
+            ys=np.array([data['y'] for node, data in nodes],
+                        dtype=np.float64),
+            edge_u=np.array([u for u, v, key, edge in edges],
+                            dtype=np.int64),
+            edge_v=np.array([v for u, v, key, edge in edges],
+                            dtype=np.int64),
+            edge_key=np.array([key for u, v, key, edge in edges],
+                              dtype=np.int64),
+            length=np.array([edge.get('length', np.nan)
+                             for u, v, key, edge in edges],
+                            dtype=np.float64),
+            bearing=np.array([edge.get('bearing', np.nan)
+                              for u, v, key, edge in edges],
+                             dtype=np.float64)
+            )
+
+    os.replace(attributes_file + '.tmp', attributes_file)
+    os.replace(arrays_file + '.tmp', arrays_file)
 
 
 def load_graph(filename):
     """
-    Load a graph object in Python gpickle format.
+    Load a graph saved with save_graph.
+    The edges get the same attributes they were saved with, except the
+    bearings of self-loops, which are NaN and so are left out.
 
     Parameters
     ----------
@@ -86,8 +284,39 @@ def load_graph(filename):
 
     """
 
-    graph = nx.read_gpickle(filename if filename[-8:] == '.gpickle'
-                            else filename+'.gpickle')
+    arrays_file, attributes_file = _graph_files(filename)
+
+    with np.load(arrays_file) as arrays:
+        arrays = {name: arrays[name].tolist() for name in arrays.files}
+    with open(attributes_file) as file:
+        attributes = json.load(file)
+    # The files of two different saves, if one was interrupted between them.
+    if len(attributes['osmid']) != len(arrays['edge_u']):
+        raise ValueError("The files of " + filename + " don't match.")
+
+    graph = nx.MultiDiGraph(**attributes['graph'])
+    graph.add_nodes_from(
+        (node, {'x': x, 'y': y})
+        for node, x, y in zip(arrays['nodes_id'], arrays['xs'], arrays['ys']))
+
+    # The attributes the saved edges didn't have were saved as NaN or None,
+    # so they are left out again.
+    values = zip(attributes['osmid'], arrays['length'], arrays['bearing'],
+                 attributes['name'])
+    edges = []
+    for u, v, key, (osmid, length, bearing, name) in zip(
+            arrays['edge_u'], arrays['edge_v'], arrays['edge_key'], values):
+        edge = {}
+        if osmid is not None:
+            edge['osmid'] = osmid
+        if not isnan(length):
+            edge['length'] = length
+        if not isnan(bearing):
+            edge['bearing'] = bearing
+        if name is not None:
+            edge['name'] = name
+        edges.append((u, v, key, edge))
+    graph.add_edges_from(edges)
     return graph
 
 
@@ -107,19 +336,182 @@ def print_graph(graph):
 
     """
 
-    text_file = open("graph-info-debug.txt", "w")
-    for node1, info1 in graph.nodes.items():
-        # For each adjacent node and its information...
-        for node2, info2 in graph.adj[node1].items():
-            try:
-                text_file.write(str(info2[0]))
-            # Some caracters can't be encoded on some graphs
-            except:
-                text_file.write("Couldn't get values for this edge")
-        text_file.write("\n")
-    text_file.write("\n")
+    with open("graph-info-debug.txt", "w", buffering=1 << 20) as text_file:
+        lines = []
+        for node1, info1 in graph.nodes.items():
+            # For each adjacent node and its information...
+            for node2, info2 in graph.adj[node1].items():
+                edge = str(info2[0])
+                # Some caracters can't be encoded on some graphs
+                try:
+                    edge.encode(text_file.encoding)
+                except UnicodeEncodeError:
+                    edge = "Couldn't get values for this edge"
+                lines.append(edge)
+            lines.append("\n")
+        lines.append("\n")
+
+        text_file.writelines(lines)
+
+
+def _to_sphere(lats, lons):
+    """
+    Convert coordinates in degrees to (x, y, z) points on the unit sphere,
+    where the euclidean distance grows with the great circle distance.
+    """
+
+    lats, lons = np.radians(lats), np.radians(lons)
+    return np.column_stack((np.cos(lats) * np.cos(lons),
+                            np.cos(lats) * np.sin(lons),
+                            np.sin(lats)))
+
+
+def index_graph(graph):
+    """
+    Build the spatial indexes get_directions uses to find the nearest nodes
+    and edges of the graph without scanning all of them: a KD-tree of the
+    nodes and an R-tree of the edges. Tables of the edge attributes are also
+    built, to describe routes without walking the graph.
+    The indexes are built once per graph, the first time they are needed,
+    so calling this function in advance avoids slowing down the first route.
+
+    Parameters
+    ----------
+    graph : networkx multidigraph
+        The graph to be indexed.
+
+    Returns
+    -------
+    index : dict
+        The indexes of the graph with the following elements:
+            kdtree: scipy cKDTree of the nodes as points on the unit sphere.
+            node_ids: numpy array with the node of each point of kdtree.
+            rtree: rtree Index of the bounding boxes of the edges.
+            edges: list with the (u, v) nodes of each edge of rtree.
+            edge_osmids: list with the osmid of each edge of rtree.
+            segments: numpy array with the (x1, y1, x2, y2) of each edge.
+            osmid, bearing, length, name: dicts with that attribute of the
+                first edge between each (u, v) pair of nodes. Only the
+                first name of the edges with several names is kept.
+            paths, routes: the last shortest paths and routes computed on
+                the graph.
+
+    """
+
+    if graph in _INDEXES:
+        return _INDEXES[graph]
+
+    node_ids = np.array(list(graph.nodes))
+    lats = [graph.nodes[node]['y'] for node in node_ids]
+    lons = [graph.nodes[node]['x'] for node in node_ids]
+
+    # The attributes of the first edge between each pair of nodes, which
+    # are the ones routes are described with.
+    edges, edge_osmids = [], []
+    osmids, bearings, lengths, names = {}, {}, {}, {}
+    for u, v, key, data in graph.edges(keys=True, data=True):
+        if key == 0:
+            edges.append((u, v))
+            edge_osmids.append(data.get('osmid'))
+            osmids[u, v] = edge_osmids[-1]
+            bearings[u, v] = data.get('bearing')
+            lengths[u, v] = data.get('length')
+            # Some edges have more than one street name
+            name = data.get('name')
+            names[u, v] = name[0] if isinstance(name, list) else name
+
+    # The geometry of the edges is removed on download, so each edge is the
+    # straight segment between its nodes.
+    segments = np.array([(graph.nodes[u]['x'], graph.nodes[u]['y'],
+                          graph.nodes[v]['x'], graph.nodes[v]['y'])
+                         for u, v in edges], dtype=np.float64).reshape(-1, 4)
+    bounds = np.column_stack((np.minimum(segments[:, 0], segments[:, 2]),
+                              np.minimum(segments[:, 1], segments[:, 3]),
+                              np.maximum(segments[:, 0], segments[:, 2]),
+                              np.maximum(segments[:, 1], segments[:, 3])))
+
+    index = {
+        'kdtree': cKDTree(_to_sphere(lats, lons)),
+        'node_ids': node_ids,
+        # Bulk loading is much faster than inserting the edges one by one.
+        'rtree': rtree.index.Index((i, tuple(box), None)
+                                   for i, box in enumerate(bounds)),
+        'edges': edges,
+        'edge_osmids': edge_osmids,
+        'segments': segments,
+        'osmid': osmids,
+        'bearing': bearings,
+        'length': lengths,
+        'name': names,
+        'paths': _LRUCache(CACHED_PATHS),
+        'routes': _LRUCache(CACHED_ROUTES)
+        }
+    _INDEXES[graph] = index
+
+    return index
+
+
+def _nearest_node(index, location):
+    """
+    Return the nearest node of the indexed graph to the (latitude, longitude)
+    location and its distance in meters.
+    """
+
+    chord, i = index['kdtree'].query(_to_sphere(*location)[0])
+    # The chord between two points of the unit sphere gives their great
+    # circle distance.
+    return (index['node_ids'][i].item(),
+            2 * EARTH_RADIUS * asin(min(chord / 2, 1)))
+
+
+def _nearest_edge(index, location):
+    """
+    Return the position, in the R-tree and the edge lists of the index, of
+    the nearest edge of the indexed graph to the (latitude, longitude)
+    location.
+    """
+
+    y, x = location
+    candidates = EDGE_CANDIDATES
+    while True:
+        found = np.fromiter(index['rtree'].nearest((x, y, x, y), candidates),
+                            dtype=np.int64)
+        x1, y1, x2, y2 = index['segments'][found].T
+
+        # Distance from the location to each candidate segment.
+        dx, dy = x2 - x1, y2 - y1
+        squared = dx*dx + dy*dy
+        t = np.clip(((x - x1)*dx + (y - y1)*dy) /
+                    np.where(squared > 0, squared, 1), 0, 1)
+        distances = np.hypot(x1 + t*dx - x, y1 + t*dy - y)
+        best = np.argmin(distances)
+
+        # Any edge that is not a candidate has its bounding box, and so
+        # itself, farther than the farthest candidate box. Otherwise more
+        # candidates are needed.
+        left, right = np.minimum(x1, x2), np.maximum(x1, x2)
+        bottom, top = np.minimum(y1, y2), np.maximum(y1, y2)
+        box_distances = np.hypot(
+            np.maximum(left - x, 0) + np.maximum(x - right, 0),
+            np.maximum(bottom - y, 0) + np.maximum(y - top, 0))
+        if (len(found) < candidates or
+                distances[best] <= box_distances.max()):
+            return int(found[best])
+        candidates *= 2
+
+
+def _shortest_path(graph, index, source_node, destiny_node):
+    """
+    Compute the shortest path between two nodes of the indexed graph,
+    remembering the last paths computed so repeated routes are not searched
+    again.
+    """
 
-    text_file.close()
+    # Searching from both ends settles far fewer nodes than from the source.
+    return index['paths'].get(
+        (source_node, destiny_node),
+        lambda: tuple(nx.bidirectional_dijkstra(
+            graph, source_node, destiny_node, weight='length')[1]))
 
 
 def get_directions(graph, source_location, destination_location):
@@ -130,6 +522,11 @@ def get_directions(graph, source_location, destination_location):
     The user can proceed the route by following each section (starting
     from the initial point (src), then going to (mid), and keep going forward
     on each section until the end is reached).
+    The graph is only read, so routes can be computed from several threads
+    at the same time.
+    The locations are rounded to LOCATION_DECIMALS decimals, and the last
+    routes computed are remembered, so a repeated route is not computed
+    again.
 
     Parameters
     ----------
@@ -152,136 +549,255 @@ def get_directions(graph, source_location, destination_location):
 
     """
 
-    # To ensure src_node and dst_node are not outside the graph.
-    source_node, src_distance = ox.get_nearest_node(graph, source_location,
-                                                    return_dist=True)
-    assert src_distance < FARTHEST_NODE, "source is out of bounds"
+    source_location = _round_location(source_location)
+    destination_location = _round_location(destination_location)
+    route = index_graph(graph)['routes'].get(
+        (source_location, destination_location), _get_directions,
+        graph, source_location, destination_location)
+    # A copy of each section, because the caller may change them.
+    return [dict(section) for section in route]
 
-    destiny_node, dst_distance = ox.get_nearest_node(graph,
-                                                     destination_location,
-                                                     return_dist=True)
-    assert dst_distance < FARTHEST_NODE, "destination is out of bounds"
 
-    path = nx.shortest_path(graph, source_node, destiny_node, weight='length')
+def _round_location(location):
+    """
+    Round the (latitude, longitude) location to LOCATION_DECIMALS decimals.
+    """
 
-    if len(path) > 1:
-        # To optimize the route, a new graph is created from truncating
-        # the original with a radius from the 'source_node' to find the
-        # nearest edge from source_location, otherwise the function would look
-        # for all edges, which we don't need to.
-        # The same it's made with the destination_location
-        try:
-            src_graph = ox.truncate_graph_dist(graph, source_node,
-                                               max_distance=src_distance +
-                                               FIND_DST)
+    return tuple(round(coordinate, LOCATION_DECIMALS)
+                 for coordinate in location)
 
-            first_edge = ox.get_nearest_edge(src_graph, source_location)
-            edge_data = graph.get_edge_data(first_edge[1], first_edge[2],
-                                            key=0)
 
-            # If the nearest edge is the same as the first edge on the path,
-            # the first path node can be removed, otherwise the path would take
-            # an innecessary turn.
-            if (edge_data['osmid'] == graph.get_edge_data(path[0], path[1],
-                                                          key=0)['osmid']):
-                path.pop(0)
+def _get_directions(graph, source_location, destination_location):
+    """
+    Compute the route of get_directions.
+    """
 
-        except:
-            print("Warning: FIND_DST is not large enough to find a edge near",
-                  "the source_location. Route may not be optimized.")
+    index = index_graph(graph)
+    source_node, destiny_node = _end_nodes(index, source_location,
+                                           destination_location)
 
-        # Similar is done with the last path node
-        try:
-            dst_graph = ox.truncate_graph_dist(graph, destiny_node,
-                                               max_distance=dst_distance +
-                                               FIND_DST)
+    # A copy, because the path is trimmed by _route.
+    path = list(_shortest_path(graph, index, source_node, destiny_node))
+    return _route(graph, index, path, source_location, destination_location)
+
+
+def _end_nodes(index, source_location, destination_location):
+    """
+    Return the nearest nodes of the indexed graph to the source and
+    destination locations, asserting both are in the bounds of the graph.
+    """
+
+    # To ensure src_node and dst_node are not outside the graph.
+    source_node, src_distance = _nearest_node(index, source_location)
+    assert src_distance < FARTHEST_NODE, "source is out of bounds"
+
+    destiny_node, dst_distance = _nearest_node(index, destination_location)
+    assert dst_distance < FARTHEST_NODE, "destination is out of bounds"
 
-            last_edge = ox.get_nearest_edge(dst_graph, destination_location)
-            edge_data = graph.get_edge_data(last_edge[1], last_edge[2], key=0)
+    return source_node, destiny_node
+
+
+def _route(graph, index, path, source_location, destination_location):
+    """
+    Describe the route from source_location to destination_location that
+    follows the path of nodes, as returned by get_directions. The path list
+    is trimmed in place.
+    """
 
-            if (edge_data['osmid'] == graph.get_edge_data(path[-2], path[-1],
-                                                          key=0)['osmid']):
-                path.pop(-1)
+    if len(path) > 1:
+        # If the nearest edge to the source_location is the same as the first
+        # edge on the path, the first path node can be removed, otherwise the
+        # path would take an innecessary turn.
+        first_edge = _nearest_edge(index, source_location)
+        if (index['edge_osmids'][first_edge] ==
+                index['osmid'][path[0], path[1]]):
+            path.pop(0)
 
-        except:
-            print("Warning: FIND_DST is not large enough to find a edge near",
-                  "the destination_location. Route may not be optimized.")
+    if len(path) > 1:
+        # Similar is done with the last path node
+        last_edge = _nearest_edge(index, destination_location)
+        if (index['edge_osmids'][last_edge] ==
+                index['osmid'][path[-2], path[-1]]):
+            path.pop(-1)
 
     # Insertion of 'source_location' and 'destination_location' on the path.
     # 'end' is an imaginary next node which won't exist in the graph.
+    # None of them is added to the graph, which is only read.
     path.insert(0, 'src_node')
     path.extend(('dst_node', 'end'))
 
-    # Insertion of 'source_location' and 'destination_location' as new nodes on
-    # the graph
-    graph.add_node('src_node', y=source_location[0], x=source_location[1])
-    graph.add_node('dst_node', y=destination_location[0],
-                   x=destination_location[1])
-    graph.add_node('end')
+    # The coordinates of all the path nodes are gathered at once. The
+    # imaginary node 'end' has no coordinates, so it gets NaN.
+    xs = np.empty(len(path), dtype=np.float64)
+    ys = np.empty(len(path), dtype=np.float64)
+    xs[1:-2] = np.fromiter((graph.nodes[node]['x'] for node in path[1:-2]),
+                           dtype=np.float64, count=len(path) - 3)
+    ys[1:-2] = np.fromiter((graph.nodes[node]['y'] for node in path[1:-2]),
+                           dtype=np.float64, count=len(path) - 3)
+    ys[0], xs[0] = source_location
+    ys[-2], xs[-2] = destination_location
+    xs[-1] = ys[-1] = np.nan
 
     # Last edge bearing calculation
-    origin = tuple(graph.nodes[path[-3]][coord] for coord in ('x', 'y'))
+    origin = (xs[-3].item(), ys[-3].item())
     final = destination_location[::-1]
 
-    # To ensure the polar bearing is calculated correctly
-    last_bear = (ox.get_bearing(origin, final)
-                 if origin <= final else ox.get_bearing(final, origin))
-
-    # Connections of new nodes on the graph
-    graph.add_edges_from([
-        (path[0], path[1]),
-        (path[-2], path[-1])
-        ])
-    graph.add_edge(path[-3], path[-2], bearing=last_bear)
-
-    # Iteration over 'path' nodes to write 'route' information
-    route = []
-    mid, dst = path[0], path[1]
-    for node in path[2:]:
-        src, mid, dst = mid, dst, node
-        # 'sm_edge' and 'md_edge' represent src-mid and mid-dst respectively
-        sm_edge = graph.get_edge_data(src, mid, key=0)
-        md_edge = graph.get_edge_data(mid, dst, key=0)
+    # To ensure the polar bearing is calculated correctly. The (x, y) points
+    # are taken as (latitude, longitude), as they were by ox.get_bearing.
+    last_bear = float(_bearings(*min(origin, final), *max(origin, final)))
 
-        try:
-            angle = (md_edge['bearing'] - sm_edge['bearing']) % 360
-        except:
-            angle = None
+    # The edge attributes are read from the tables of the index. The edges
+    # from and to the new nodes have no attributes but the bearing of the
+    # last one.
+    bearings = collections.ChainMap({(path[-3], path[-2]): last_bear},
+                                    index['bearing'])
+    edges = list(zip(path, path[1:]))
 
-        current_name = sm_edge.get('name')
-        # Some edges have more than one street name
-        if type(current_name) == list:
-            current_name = current_name[0]
+    return _assemble_route(
+        xs, ys,
+        np.array([bearings.get(edge) for edge in edges], dtype=np.float64),
+        [index['length'].get(edge) for edge in edges],
+        [index['name'].get(edge) for edge in edges])
 
-        length = sm_edge.get('length')
 
-        next_name = md_edge.get('name')
-        if type(next_name) == list:
-            next_name = next_name[0]
+def _assemble_route(xs, ys, bearings, lengths, names):
+    """
+    Build the sections of a route from the columns of its path: the xs and
+    ys arrays with the coordinates of its nodes, which are NaN for the
+    imaginary last node, and the bearings array and the lengths and names
+    lists of the edges from each node to the next one.
+    """
 
-        route.append({
-            'angle': angle,
-            'current_name': current_name,
+    coords = list(zip(xs.tolist(), ys.tolist()))
+
+    # Desviation angles between each path edge and the next one. The edges
+    # without bearing get NaN, so their angles are NaN too.
+    angles = [None if np.isnan(angle) else angle
+              for angle in np.mod(np.diff(bearings), 360).tolist()]
+
+    # Iteration over 'path' nodes to write 'route' information. Section 'i'
+    # goes from node 'i' (src) to node 'i + 1' (mid), and then turns to
+    # node 'i + 2' (dst).
+    route = [None] * (len(coords) - 2)
+    for i in range(len(route)):
+        route[i] = {
+            'angle': angles[i],
+            'current_name': names[i],
             # To distinguix the imaginary node 'end' which has no coordinates.
-            'dst': (tuple(graph.nodes[dst][unit] for unit in ('x', 'y'))
-                    if graph.nodes[dst] else None),
-            'length': length,
-            'mid': tuple(graph.nodes[mid][unit] for unit in ('x', 'y')),
-            'next_name': next_name,
-            'src': tuple(graph.nodes[src][unit] for unit in ('x', 'y'))
-                })
-
-    # Removal of previous added nodes and edges on the graph
-    graph.remove_nodes_from(('src_node', 'dst_node', 'end'))
-    graph.remove_edges_from([
-        (path[0], path[1]),
-        (path[-3], path[-2]),
-        (path[-2], path[-1])
-        ])
+            'dst': coords[i + 2] if not np.isnan(xs[i + 2]) else None,
+            'length': lengths[i],
+            'mid': coords[i + 1],
+            'next_name': names[i + 1],
+            'src': coords[i]
+            }
 
     return route
 
 
+def _length_matrix(graph):
+    """
+    Return the sparse matrix with the length of the shortest edge from each
+    node to each other node of the graph, and the dict with the position of
+    each node on the matrix. The matrix is built the first time it's needed
+    and kept with the indexes of the graph.
+    """
+
+    index = index_graph(graph)
+    if 'matrix' not in index:
+        positions = {node: i for i, node in enumerate(index['node_ids'])}
+        # The edges without length weigh 1, as on _shortest_path.
+        edges = list(graph.edges(data='length', default=1))
+        rows = np.array([positions[u] for u, v, length in edges],
+                        dtype=np.int64)
+        columns = np.array([positions[v] for u, v, length in edges],
+                           dtype=np.int64)
+        lengths = np.array([length for u, v, length in edges],
+                           dtype=np.float64)
+
+        # Parallel edges would be added up on the matrix, so only the
+        # shortest one is kept.
+        order = np.lexsort((lengths, columns, rows))
+        rows, columns, lengths = rows[order], columns[order], lengths[order]
+        shortest = np.ones(len(order), dtype=bool)
+        shortest[1:] = (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])
+
+        # The edges of length 0 would be taken as missing edges, so they get
+        # the smallest length instead.
+        lengths = np.maximum(lengths[shortest], np.finfo(np.float64).tiny)
+        index['positions'] = positions
+        index['matrix'] = csr_matrix(
+            (lengths, (rows[shortest], columns[shortest])),
+            shape=(len(positions), len(positions)))
+
+    return index['matrix'], index['positions']
+
+
+def get_directions_batch(graph, source_locations, destination_locations):
+    """
+    Compute the shortest route from each source location to its destination
+    location on the graph, as get_directions does, but searching the paths
+    of all the routes with a single call to scipy's dijkstra. The routes that
+    start at the same node share their search, so many routes are computed
+    much faster than one by one.
+
+    Parameters
+    ----------
+    graph : networkx multidigraph
+        The graph where all the information is taken.
+    source_locations : list
+        The (latitude, longitude) where each route starts.
+    destination_locations : list
+        The (latitude, longitude) that represents the destination of each
+        route. It must have the same length as source_locations.
+
+    Returns
+    -------
+    routes : list
+        The route of each pair of locations, as returned by get_directions.
+
+    """
+
+    if len(source_locations) != len(destination_locations):
+        raise ValueError("There must be as many source locations as "
+                         "destination locations.")
+
+    index = index_graph(graph)
+    matrix, positions = _length_matrix(graph)
+
+    locations = [(_round_location(source_location),
+                  _round_location(destination_location))
+                 for source_location, destination_location
+                 in zip(source_locations, destination_locations)]
+    nodes = [_end_nodes(index, source_location, destination_location)
+             for source_location, destination_location in locations]
+
+    # One search from each different source node.
+    sources = list({source_node for source_node, destiny_node in nodes})
+    predecessors = dijkstra(matrix, indices=[positions[node]
+                                             for node in sources],
+                            return_predecessors=True)[1]
+    rows = {node: row for row, node in enumerate(sources)}
+
+    routes = []
+    for (source_node, destiny_node), route_locations in zip(nodes, locations):
+        # The path is followed backwards from the destiny node.
+        predecessor = predecessors[rows[source_node]]
+        source_position = positions[source_node]
+        position = positions[destiny_node]
+        path = [destiny_node]
+        while position != source_position:
+            position = predecessor[position]
+            if position < 0:
+                raise nx.NetworkXNoPath("No path between {} and {}.".format(
+                    source_node, destiny_node))
+            path.append(index['node_ids'][position].item())
+        path.reverse()
+
+        routes.append(_route(graph, index, path, *route_locations))
+
+    return routes
+
+
 def plot_directions(graph, source_location, destination_location, directions,
                     filename, width=400, height=400):
     """
@@ -302,8 +818,9 @@ def plot_directions(graph, source_location, destination_location, directions,
         A list of dicts that represents sections of the directions.
         The attributes 'src' and 'mid' must be tuples of (longitude, latitude)
         and have to be on each element of the list.
-    filename : string
-        The plot where the png file will be saved.
+    filename : string or file object
+        The plot where the png file will be saved. A file object, such as
+        an io.BytesIO, keeps the image in memory.
     width : int, optional
         The width resolution of the file. The function is optimized to work
         best with the default value. The default is 400.
@@ -313,49 +830,42 @@ def plot_directions(graph, source_location, destination_location, directions,
 
     Returns
     -------
-    filename : string
+    filename : string or file object
         Where the image of the plot is saved.
 
     """
 
-    mapa = StaticMap(width, height)
+    mapa = _CachedStaticMap(width, height)
 
     if directions:
-        # Print the first node (source_location)
-        mapa.add_marker(IconMarker(directions[0]['src'], 'icon-location.png',
-                                   40, 40))
-
-        # Print all the nodes and edges
-        for street in directions[:-1]:
-            mapa.add_marker(CircleMarker(street['mid'], '#d12b2b', 9))
-            edge = [street['src'], street['mid']]
-            mapa.add_line(Line(edge, '#ff3333', 4))
-
-        # Print the last node and edge (destination_location)
-        mapa.add_marker(IconMarker(directions[-1]['mid'], 'icon-flag.png',
-                                   40, 40))
-        edge = [directions[-1]['src'], directions[-1]['mid']]
-        mapa.add_line(Line(edge, '#ff3333', 4))
+        # Print the first node (source_location), all the nodes and the last
+        # node (destination_location)
+        mapa.markers.append(IconMarker(directions[0]['src'],
+                                       'icon-location.png', 40, 40))
+        mapa.markers.extend(CircleMarker(street['mid'], '#d12b2b', 9)
+                            for street in directions[:-1])
+        mapa.markers.append(IconMarker(directions[-1]['mid'], 'icon-flag.png',
+                                       40, 40))
 
-    else:
-        if destination_location:
+        # Print all the edges
+        mapa.lines.extend(Line([street['src'], street['mid']], '#ff3333', 4)
+                          for street in directions)
 
-            # Print source_location
-            mapa.add_marker(IconMarker(source_location[::-1],
-                                       'icon-location.png', 40, 40))
+    else:
+        # Print source_location
+        mapa.add_marker(IconMarker(source_location[::-1],
+                                   'icon-location.png', 40, 40))
 
+        if destination_location:
             # Print destination_location
             mapa.add_marker(IconMarker(destination_location[::-1],
                                        'icon-flag.png', 40, 40))
 
-        else:
-            # Print source_location
-            mapa.add_marker(IconMarker(source_location[::-1],
-                                       'icon-location.png', 40, 40))
-
     # Render of the map
     imatge = mapa.render()
     # The user may have not passed the .png extension on the filename
-    imatge.save(filename if filename[-4:] == '.png' else filename+'.png')
+    if isinstance(filename, str) and filename[-4:] != '.png':
+        filename += '.png'
+    imatge.save(filename, format='PNG')
 
     return filename
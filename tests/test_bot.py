@@ -0,0 +1,82 @@
+import pytest
+
+pytest.importorskip('telegram')
+pytest.importorskip('osmnx')
+
+import bot  # noqa: E402
+
+
+def _old_turn(angle):
+    """
+    The indications as the bot chose them before _TURNS existed.
+    """
+
+    if angle:
+        if 0 < angle < 22.5:
+            return "Go straight"
+        elif angle < 67.5:
+            return "Turn half right"
+        elif angle < 112.5:
+            return "Turn right"
+        elif angle < 180:
+            return "Turn strong right"
+        elif angle < 247.5:
+            return "Turn strong left"
+        elif angle < 292.5:
+            return "Turn left"
+        elif angle < 337.5:
+            return "Turn half left"
+        return "Go straight"
+    return "Go straight"
+
+
+def _old_final(angle):
+    """
+    Where the destination was before _FINAL_TURNS existed.
+    """
+
+    if angle:
+        if 0 < angle < 22.5:
+            return "in front of you"
+        elif angle < 180:
+            return "at your right"
+        elif angle < 337.5:
+            return "at your left"
+        return "in front of you"
+    return "in front of you"
+
+
+# Every 22.5 degrees threshold and the angles right around it, within the
+# [0, 360) range of the route angles.
+ANGLES = sorted({angle for k in range(17)
+                 for angle in (k * 22.5 - 1e-9, k * 22.5, k * 22.5 + 1e-9)
+                 if 0 <= angle < 360})
+
+
+@pytest.mark.parametrize('angle', ANGLES)
+def test_classify_turn_matches_old_ladder(angle):
+    assert bot._classify_turn(angle) == _old_turn(angle)
+
+
+@pytest.mark.parametrize('angle', ANGLES)
+def test_classify_final_matches_old_ladder(angle):
+    assert bot._classify_final(angle) == _old_final(angle)
+
+
+def test_classify_without_angle():
+    for angle in (None, float('nan')):
+        assert bot._classify_turn(angle) == "Go straight"
+        assert bot._classify_final(angle) == "in front of you"
+
+
+@pytest.mark.parametrize('text', [
+    'Sagrada Familia', 'Plaça de Catalunya', 'UPC', 'Carrer de Mallorca 401'])
+def test_looks_like_place(text):
+    assert bot._looks_like_place(text)
+
+
+@pytest.mark.parametrize('text', [
+    '', 'ok', '/start', '@someone', 'https://example.com', '12345 678',
+    ':) :) :)', 'a' * 81])
+def test_does_not_look_like_place(text):
+    assert not bot._looks_like_place(text)
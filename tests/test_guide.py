@@ -0,0 +1,143 @@
+import math
+import random
+
+import pytest
+
+pytest.importorskip('osmnx')
+pytest.importorskip('rtree')
+pytest.importorskip('scipy')
+pytest.importorskip('staticmap')
+
+import networkx as nx  # noqa: E402
+import guide as gd  # noqa: E402
+
+
+SOURCE = (41.3800, 2.1500)
+DESTINATION = (41.3820, 2.1500)
+
+
+def _graph():
+    """
+    A graph of three nodes in a straight street, whose first edge has no
+    length.
+    """
+
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    graph.add_node(1, y=41.3800, x=2.1500)
+    graph.add_node(2, y=41.3810, x=2.1500)
+    graph.add_node(3, y=41.3820, x=2.1500)
+    graph.add_edge(1, 2, osmid=10, name='Carrer A', bearing=0.0)
+    graph.add_edge(2, 3, osmid=11, name=['Carrer B', 'Carrer C'],
+                   length=111.2, bearing=0.0)
+    return graph
+
+
+def _grid(side=6):
+    """
+    A grid of streets with slightly moved nodes, two ways on each street.
+    """
+
+    rnd = random.Random(0)
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    for i in range(side):
+        for j in range(side):
+            graph.add_node(i * side + j,
+                           y=41.38 + i * 0.001 + rnd.uniform(-2e-4, 2e-4),
+                           x=2.15 + j * 0.0012 + rnd.uniform(-2e-4, 2e-4))
+    for i in range(side):
+        for j in range(side):
+            node = i * side + j
+            for neighbour in ((node + 1) if j + 1 < side else None,
+                              (node + side) if i + 1 < side else None):
+                if neighbour is not None:
+                    for u, v in ((node, neighbour), (neighbour, node)):
+                        graph.add_edge(u, v, osmid=min(u, v), length=100.0,
+                                       highway='residential')
+    return graph
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    h = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) *
+         math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * gd.EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+def _segment_distance(x, y, x1, y1, x2, y2):
+    dx, dy = x2 - x1, y2 - y1
+    squared = dx * dx + dy * dy
+    t = 0 if squared == 0 else max(0, min(1, ((x - x1) * dx +
+                                               (y - y1) * dy) / squared))
+    return math.hypot(x1 + t * dx - x, y1 + t * dy - y)
+
+
+def _points(count=300):
+    rnd = random.Random(1)
+    return [(41.38 + rnd.uniform(-0.002, 0.007),
+             2.15 + rnd.uniform(-0.002, 0.008)) for i in range(count)]
+
+
+def test_nearest_node_matches_brute_force():
+    graph = _grid()
+    index = gd.index_graph(graph)
+    for lat, lon in _points():
+        node, distance = gd._nearest_node(index, (lat, lon))
+        distances = {n: _haversine(lat, lon, data['y'], data['x'])
+                     for n, data in graph.nodes(data=True)}
+        assert distance == pytest.approx(min(distances.values()), abs=1e-3)
+        assert distances[node] == pytest.approx(distance, abs=1e-3)
+
+
+def test_nearest_edge_matches_brute_force():
+    graph = _grid()
+    index = gd.index_graph(graph)
+    nodes = graph.nodes
+    for lat, lon in _points():
+        position = gd._nearest_edge(index, (lat, lon))
+        u, v = index['edges'][position]
+        best = min(_segment_distance(lon, lat, nodes[a]['x'], nodes[a]['y'],
+                                     nodes[b]['x'], nodes[b]['y'])
+                   for a, b in graph.edges())
+        found = _segment_distance(lon, lat, nodes[u]['x'], nodes[u]['y'],
+                                  nodes[v]['x'], nodes[v]['y'])
+        assert found == pytest.approx(best, abs=1e-12)
+        assert index['edge_osmids'][position] == graph.edges[u, v, 0]['osmid']
+
+
+def test_prepare_edges_bearings():
+    graph = _grid()
+    graph.add_edge(0, 0, osmid=99, length=5.0)
+    gd._prepare_edges(graph)
+
+    for u, v, edge in graph.edges(data=True):
+        assert set(edge) <= gd.EDGE_ATTRIBUTES
+        if u == v:
+            assert math.isnan(edge['bearing'])
+            continue
+        lat1, lat2 = (math.radians(graph.nodes[n]['y']) for n in (u, v))
+        delta = math.radians(graph.nodes[v]['x'] - graph.nodes[u]['x'])
+        x = math.sin(delta) * math.cos(lat2)
+        y = (math.cos(lat1) * math.sin(lat2) -
+             math.sin(lat1) * math.cos(lat2) * math.cos(delta))
+        expected = (math.degrees(math.atan2(x, y)) + 360) % 360
+        assert edge['bearing'] == pytest.approx(round(expected, 3), abs=1e-9)
+
+
+def test_round_trip_keeps_missing_length(tmp_path):
+    graph = _graph()
+    filename = str(tmp_path / 'graph')
+    gd.save_graph(graph, filename)
+    loaded = gd.load_graph(filename)
+
+    assert list(loaded.nodes(data=True)) == list(graph.nodes(data=True))
+    assert (list(loaded.edges(keys=True, data=True)) ==
+            list(graph.edges(keys=True, data=True)))
+    assert 'length' not in loaded.edges[1, 2, 0]
+
+    assert (gd.get_directions_batch(loaded, [SOURCE], [DESTINATION]) ==
+            gd.get_directions_batch(graph, [SOURCE], [DESTINATION]))
+
+
+def test_batch_needs_a_destination_for_each_source():
+    with pytest.raises(ValueError):
+        gd.get_directions_batch(_graph(), [SOURCE, SOURCE], [DESTINATION])